@@ -1,20 +1,36 @@
 import asyncio
+import contextlib
+import logging
+import concurrent.futures
+import random
+import re
+import threading
+import functools
+import uuid
+from collections import Counter
+from bisect import bisect_left, bisect_right
 from datetime import datetime, date, time
-from typing import Dict, Tuple, List
+from typing import Dict, Tuple, List, NamedTuple, Optional, Sequence
 
 import gspread
+from requests.adapters import DEFAULT_POOLSIZE, HTTPAdapter
+from requests.exceptions import ConnectTimeout, ConnectionError as RequestsConnectionError
+from urllib3.exceptions import NewConnectionError
+from google.auth.exceptions import RefreshError, TransportError
 from google.oauth2.service_account import Credentials
 from aiogram import Bot, Dispatcher, types
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.memory import MemoryStorage, SimpleEventIsolation
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.types import Message, InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram.filters import StateFilter
+from aiogram.exceptions import TelegramBadRequest
 
 import os
 from dotenv import load_dotenv
 import math
+from time import monotonic, time as unix_time
 
 load_dotenv()
 
@@ -22,11 +38,28 @@ load_dotenv()
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 SERVICE_ACCOUNT_FILE = os.getenv('SERVICE_ACCOUNT_FILE')
 SPREADSHEET_ID = os.getenv('SPREADSHEET_ID')  # либо полная ссылка/ID таблицы
+REDIS_URL = os.getenv('REDIS_URL')  # если задан — FSM хранится в Redis, иначе в памяти процесса
+REDIS_MAX_CONNECTIONS = 50  # размер пула соединений с Redis
 
 INVENTORY_SHEET_NAME = "Ресурсы лаборатории"  # лист со списком оборудования и количеством
 BOOKINGS_SHEET_NAME = "Бронирование ресурсов"    # лист с бронированиями
 
 PAGE_SIZE = 10  # показывать по 10 элементов на страницу
+CACHE_TTL = 60  # сколько секунд держать прочитанные листы в памяти
+AVAILABILITY_GRACE = 30  # сколько секунд проверка доступности перед подтверждением считается актуальной
+BOOKINGS_FLUSH_WINDOW = 0.2  # сколько секунд после первой брони собирать остальные в одну запись
+BOOKINGS_FLUSH_BATCH = 50  # максимум броней в одном запросе к таблице
+BOOKINGS_RETRY_DELAY = 5  # пауза перед повторной записью после ошибки, секунд
+MAX_CONCURRENT_UPDATES = 200  # сколько апдейтов Telegram обрабатывать одновременно (больше — поллинг ждёт)
+MAX_PENDING_PER_CHAT = 5  # сколько апдейтов одного чата может ждать своей очереди; лишние отбрасываются
+SHEETS_POOL_SIZE = int(os.getenv('SHEETS_POOL_SIZE', '8'))  # потоков для запросов к Google Sheets
+SHEETS_RETRIES = 5  # попыток запроса к таблице при превышении квоты (HTTP 429)
+SHEETS_BACKOFF_BASE = 1  # начальная пауза между попытками, секунд (растёт вдвое)
+SHEETS_BACKOFF_MAX = 32
+
+# Слова для текстового ответа на шаге подтверждения
+CANCEL_WORDS = frozenset({"отмена", "cancel", "нет", "no"})
+CONFIRM_WORDS = frozenset({"да", "ok", "yes"})
 
 # Формат колонок на листе BOOKINGS (в этом порядке при записи)
 BOOKING_COLUMNS = [
@@ -41,7 +74,59 @@ BOOKING_COLUMNS = [
 
 # Инициализация бота и диспетчера
 bot = Bot(token=TELEGRAM_BOT_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+
+def make_storage():
+    """
+    Возвращает (хранилище FSM, изоляцию событий). Изоляция обрабатывает апдейты
+    одного чата строго по очереди (двойное нажатие «Подтвердить» не запишет бронь
+    дважды), а разных чатов — параллельно. Блокировка берётся до чтения состояния,
+    поэтому следующий апдейт видит состояние, оставленное предыдущим.
+    """
+    if REDIS_URL:
+        # Redis позволяет запускать несколько процессов бота и переживает перезапуск
+        from aiogram.fsm.storage.redis import RedisStorage
+        from redis.asyncio import BlockingConnectionPool, Redis
+        # при исчерпании пула запрос ждёт свободное соединение, а не открывает новое
+        pool = BlockingConnectionPool.from_url(REDIS_URL, max_connections=REDIS_MAX_CONNECTIONS)
+        storage = RedisStorage(redis=Redis(connection_pool=pool))
+        # блокировка в Redis действует для всех процессов бота
+        return storage, storage.create_isolation()
+    # один процесс: состояние в памяти, без сетевых запросов на каждое get_data/update_data
+    return MemoryStorage(), SimpleEventIsolation()
+
+storage, events_isolation = make_storage()
+# FSM-мидлварь подключаем сами (ниже), чтобы ограничение на чат стояло перед ней
+dp = Dispatcher(storage=storage, events_isolation=events_isolation, disable_fsm=True)
+
+# Каждый апдейт занимает одно из MAX_CONCURRENT_UPDATES мест ещё до того, как
+# дождётся блокировки своего чата. Чтобы один чат (например, частые нажатия +/-,
+# пока его подтверждение ждёт квоту Google) не занял все места и не остановил
+# поллинг для остальных, у чата может ждать не больше MAX_PENDING_PER_CHAT апдейтов.
+_chat_pending: Dict[int, int] = {}  # chat_id -> число апдейтов в обработке или в ожидании
+
+async def limit_per_chat(handler, event, data):
+    chat = data.get("event_chat")
+    if chat is None:
+        return await handler(event, data)
+    pending = _chat_pending.get(chat.id, 0)
+    if pending >= MAX_PENDING_PER_CHAT:
+        logging.debug("Чат %s: слишком много апдейтов в очереди, апдейт %s пропущен", chat.id, event.update_id)
+        if event.callback_query:
+            # ответ нужен, иначе у пользователя будет висеть «загрузка» на кнопке
+            with contextlib.suppress(TelegramBadRequest):
+                await event.callback_query.answer("Подождите, предыдущее действие ещё выполняется.")
+        return None
+    _chat_pending[chat.id] = pending + 1
+    try:
+        return await handler(event, data)
+    finally:
+        if _chat_pending[chat.id] == 1:
+            del _chat_pending[chat.id]
+        else:
+            _chat_pending[chat.id] -= 1
+
+dp.update.outer_middleware(limit_per_chat)
+dp.update.outer_middleware(dp.fsm)
 
 # FSM для процесса бронирования
 class BookingStates(StatesGroup):
@@ -54,200 +139,734 @@ class BookingStates(StatesGroup):
     confirm = State()
 
 # ----------------- Google Sheets helper -----------------
-def init_gsheets():
+# Отдельный пул потоков для блокирующих вызовов gspread, чтобы медленные
+# запросы к таблице не занимали общий пул asyncio
+_SHEETS_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=SHEETS_POOL_SIZE, thread_name_prefix="gspread")
+
+async def _run_sheets(func, *args):
+    """
+    Выполняет блокирующий вызов gspread в пуле. Размер пула ограничивает число
+    одновременных запросов к таблице; при ответе 429 (квота) запрос повторяется
+    с экспоненциальной паузой и случайным разбросом, а не завершается ошибкой.
+    """
+    loop = asyncio.get_running_loop()
+    for attempt in range(SHEETS_RETRIES):
+        try:
+            return await loop.run_in_executor(_SHEETS_POOL, func, *args)
+        except gspread.exceptions.APIError as e:
+            status = getattr(getattr(e, 'response', None), 'status_code', None)
+            if status != 429 or attempt == SHEETS_RETRIES - 1:
+                raise
+            delay = random.uniform(0, min(SHEETS_BACKOFF_MAX, SHEETS_BACKOFF_BASE * 2 ** attempt))
+            logging.warning("Квота Google Sheets превышена, повтор через %.1f с", delay)
+            await asyncio.sleep(delay)
+
+# init_gsheets и _get_ws вызываются из потоков пула; блокировка нужна,
+# чтобы при одновременном первом обращении авторизация не выполнялась дважды
+_gsheets_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=1)
+def _open_spreadsheet():
     scopes = ["https://www.googleapis.com/auth/spreadsheets",
               "https://www.googleapis.com/auth/drive"]
     creds = Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=scopes)
     gc = gspread.authorize(creds)
+    # requests держит DEFAULT_POOLSIZE (10) соединений на хост. Если потоков
+    # _SHEETS_POOL больше, пул расширяем, иначе лишние соединения закрываются после запроса
+    session = getattr(getattr(gc, "http_client", gc), "session", None)
+    if session is not None and SHEETS_POOL_SIZE > DEFAULT_POOLSIZE:
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=SHEETS_POOL_SIZE)
+        session.mount("https://", adapter)
     sh = gc.open_by_key(SPREADSHEET_ID)
     return sh
 
-async def get_inventory() -> Dict[str, int]:
-    def _read():
+def init_gsheets():
+    # таблица открывается один раз на процесс
+    with _gsheets_lock:
+        return _open_spreadsheet()
+
+_worksheets: Dict[str, gspread.Worksheet] = {}  # имя листа -> открытый лист
+
+def _get_ws(name: str) -> gspread.Worksheet:
+    w = _worksheets.get(name)
+    if w is None:
         sh = init_gsheets()
-        try:
-            w = sh.worksheet(INVENTORY_SHEET_NAME)
-        except Exception:
-            w = sh.sheet1
+        with _gsheets_lock:
+            w = _worksheets.get(name)
+            if w is None:
+                try:
+                    w = sh.worksheet(name)
+                except gspread.exceptions.WorksheetNotFound:
+                    # запасной вариант: первый лист — инвентарь, второй — бронирования.
+                    # Другие ошибки (квота, сеть) пробрасываем: подставленный из-за них
+                    # лист остался бы в _worksheets до перезапуска
+                    w = sh.sheet1 if name == INVENTORY_SHEET_NAME else sh.get_worksheet(1)
+                _worksheets[name] = w
+    return w
+
+# Кэш прочитанных листов: value — последнее значение, ts — время чтения (monotonic)
+# для инвентаря дополнительно: ci — {имя в нижнем регистре: количество}, items — список (имя, количество)
+_inv_cache = {"value": None, "ts": 0.0, "ci": None, "items": None}
+# для бронирований: gen — номер версии, увеличивается при каждой записи брони в лист;
+# writing — сколько записей в лист выполняется прямо сейчас;
+# accepted — сколько броней принял бот (для availability_recent)
+_bk_cache = {"value": None, "ts": 0.0, "gen": 0, "writing": 0, "accepted": 0}
+# Чтения, которые выполняются прямо сейчас: ключ -> задача.
+# Одновременные запросы с тем же ключом ждут одну и ту же задачу, а не идут в таблицу сами.
+_inflight: Dict[str, asyncio.Task] = {}
+
+async def _single_flight(key: str, load):
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(load())
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    # shield: отмена одного ожидающего не должна отменять чтение для остальных
+    return await asyncio.shield(task)
+
+def _cache_fresh(cache: Dict) -> bool:
+    return cache["value"] is not None and monotonic() - cache["ts"] < CACHE_TTL
+
+def _normalize_inventory(inventory: Dict[str, int]) -> Dict[str, int]:
+    return {name.strip().lower(): cnt for name, cnt in inventory.items()}
+
+def _store_inventory(inventory: Dict[str, int], ts: float):
+    _inv_cache["value"] = inventory
+    _inv_cache["ts"] = ts
+    _inv_cache["ci"] = _normalize_inventory(inventory)
+    _inv_cache["items"] = list(inventory.items())
+
+def inventory_lookup(inventory: Dict[str, int]) -> Dict[str, int]:
+    if _inv_cache["value"] is inventory:
+        return _inv_cache["ci"]
+    return _normalize_inventory(inventory)
+
+def inventory_items(inventory: Dict[str, int]) -> List[Tuple[str, int]]:
+    # для закэшированного инвентаря список позиций уже построен
+    if _inv_cache["value"] is inventory:
+        return _inv_cache["items"]
+    return list(inventory.items())
+
+def inventory_item(inventory: Dict[str, int], key: str) -> Optional[Tuple[str, int]]:
+    """
+    Позиция инвентаря по индексу из callback_data; None, если кнопка устарела.
+    """
+    try:
+        idx = int(key)
+    except ValueError:
+        return None
+    items = inventory_items(inventory)
+    if 0 <= idx < len(items):
+        return items[idx]
+    return None
 
-        values = w.get_all_values()
-        if not values or len(values) < 2:
-            return {}
+def _add_to_bookings_cache(entries: List["PendingBooking"]):
+    """
+    Добавляет записанные брони в закэшированный индекс, чтобы не перечитывать
+    весь лист (и не сбрасывать инвентарь, который от броней не меняется).
+    В кэш попадают только чтения, не пересекавшиеся с записью (_read_bookings_consistent),
+    поэтому закэшированный индекс этих строк ещё не содержит.
+    """
+    # чтения, начатые до записи, вернут устаревшие данные — gen заставит их повториться
+    _bk_cache["gen"] += 1
+    index = _bk_cache["value"]
+    if index is None:
+        return
+    for e in entries:
+        if e.booking is None:
+            continue
+        day = index.get(e.day)
+        if day is None:
+            index[e.day] = DayBookings([e.booking.start], [e.booking])
+        else:
+            i = bisect_right(day.starts, e.booking.start)
+            day.starts.insert(i, e.booking.start)
+            day.bookings.insert(i, e.booking)
+
+def _parse_inventory(values: List[List[str]]) -> Dict[str, int]:
+    if not values or len(values) < 2:
+        return {}
 
-        headers = [h.strip().lower() for h in values[0]]
+    headers = [h.strip().lower() for h in values[0]]
 
-        # ищем нужные колонки
-        name_col = None
-        count_col = None
+    # ищем нужные колонки
+    name_col = None
+    count_col = None
 
-        for i, h in enumerate(headers):
-            if "наимен" in h or "назв" in h or "name" in h:
-                name_col = i
-            if "кол" in h or "count" in h or "количество" in h:
-                count_col = i
+    for i, h in enumerate(headers):
+        if "наимен" in h or "назв" in h or "name" in h:
+            name_col = i
+        if "кол" in h or "count" in h or "количество" in h:
+            count_col = i
 
-        if name_col is None or count_col is None:
-            return {}
+    if name_col is None or count_col is None:
+        return {}
 
-        inventory = {}
+    inventory = {}
 
-        for row in values[1:]:
-            if len(row) <= max(name_col, count_col):
-                continue
+    for row in values[1:]:
+        if len(row) <= max(name_col, count_col):
+            continue
 
-            name = row[name_col].strip()
-            count_raw = row[count_col].strip()
+        name = row[name_col].strip()
+        count_raw = row[count_col].strip()
 
-            if not name:
-                continue
+        if not name:
+            continue
 
-            try:
-                count = int(count_raw)
-            except:
-                count = 0
+        try:
+            count = int(count_raw)
+        except:
+            count = 0
 
-            inventory[name] = count
+        inventory[name] = count
 
+    return inventory
+
+async def _read_bookings_consistent(read):
+    """
+    Выполняет read() в пуле так, чтобы чтение листа бронирований не пересекалось
+    с записью: иначе нельзя сказать, попали в него новые строки или нет
+    (и они либо потеряются, либо будут посчитаны дважды).
+    """
+    for _ in range(SHEETS_RETRIES):
+        if _bk_cache["writing"]:
+            async with _flush_lock:
+                pass  # дожидаемся окончания записи
+        gen = _bk_cache["gen"]
+        result = await _run_sheets(read)
+        # за время чтения запись не начиналась и не завершалась
+        if gen == _bk_cache["gen"] and not _bk_cache["writing"]:
+            return result
+    # записи идут одна за другой — последнюю попытку делаем, не пуская их
+    async with _flush_lock:
+        return await _run_sheets(read)
+
+async def get_inventory() -> Dict[str, int]:
+    def _read():
+        w = _get_ws(INVENTORY_SHEET_NAME)
+        return _parse_inventory(w.get_all_values())
+
+    async def _load():
+        inventory = await _run_sheets(_read)
+        _store_inventory(inventory, monotonic())
         return inventory
 
-    return await asyncio.to_thread(_read)
+    if _cache_fresh(_inv_cache):
+        return _inv_cache["value"]
+    return await _single_flight(INVENTORY_SHEET_NAME, _load)
+
+async def get_bookings() -> Dict[int, "DayBookings"]:
+    """
+    Возвращает бронирования, сгруппированные по дате: {date.toordinal(): DayBookings}.
+    Строки разбираются один раз при чтении листа, а не при каждой проверке.
+    """
+    def _read():
+        w = _get_ws(BOOKINGS_SHEET_NAME)
+        values = w.get_all_values()
+        return values, _index_bookings(values)
+
+    async def _load():
+        values, bookings = await _read_bookings_consistent(_read)
+        _settle_uncertain(values)
+        _bk_cache["value"] = bookings
+        _bk_cache["ts"] = monotonic()
+        return bookings
+
+    if _cache_fresh(_bk_cache):
+        return _bk_cache["value"]
+    return await _single_flight(BOOKINGS_SHEET_NAME, _load)
+
+async def get_inventory_and_bookings() -> Tuple[Dict[str, int], Dict[int, "DayBookings"]]:
+    """
+    Читает инвентарь и бронирования одним запросом values.batchGet.
+    Если batchGet недоступен (старый gspread) — читает оба листа параллельно.
+    """
+    if _cache_fresh(_inv_cache) and _cache_fresh(_bk_cache):
+        return _inv_cache["value"], _bk_cache["value"]
+    if not hasattr(gspread.Spreadsheet, "values_batch_get"):
+        inventory, bookings = await asyncio.gather(get_inventory(), get_bookings())
+        return inventory, bookings
 
-async def get_bookings() -> List[Dict]:
     def _read():
         sh = init_gsheets()
-        try:
-            w = sh.worksheet(BOOKINGS_SHEET_NAME)
-        except Exception:
-            w = sh.get_worksheet(1)
-        rows = w.get_all_records()
-        return rows
-    return await asyncio.to_thread(_read)
+        titles = [_get_ws(INVENTORY_SHEET_NAME).title, _get_ws(BOOKINGS_SHEET_NAME).title]
+        resp = sh.values_batch_get([f"'{t}'" for t in titles])
+        inv_range, bk_range = resp.get('valueRanges', [{}, {}])
+        bk_values = bk_range.get('values', [])
+        return _parse_inventory(inv_range.get('values', [])), bk_values, _index_bookings(bk_values)
+
+    async def _load():
+        inventory, bk_values, bookings = await _read_bookings_consistent(_read)
+        _settle_uncertain(bk_values)
+        now = monotonic()
+        _store_inventory(inventory, now)
+        _bk_cache["value"], _bk_cache["ts"] = bookings, now
+        return inventory, bookings
+
+    return await _single_flight("batch", _load)
+
+# ----------------- Отложенная запись бронирований -----------------
+class PendingBooking(NamedTuple):
+    row: Sequence[str]  # кортеж значений в порядке BOOKING_COLUMNS
+    day: Optional[int]  # date.toordinal(); None, если строку не удалось разобрать
+    booking: Optional["ParsedBooking"]
+
+# Брони, принятые ботом, но ещё не записанные в таблицу. Очередь — для записи,
+# список — чтобы check_availability учитывал их до попадания в лист.
+_pending_rows: "asyncio.Queue[PendingBooking]" = asyncio.Queue()
+_unflushed: List[PendingBooking] = []
+# Брони, про которые неизвестно, записал ли их values.append (например, таймаут ответа).
+# Они остаются в _unflushed, пока свежее чтение листа не покажет, попали ли они в него
+_uncertain: List[PendingBooking] = []
+_flush_lock = asyncio.Lock()
+
+async def append_booking_row(row: Sequence[str], parsed: Optional[Tuple[int, "ParsedBooking"]] = None):
+    """
+    Ставит бронь в очередь на запись; в таблицу её запишет flush_bookings_loop().
+    parsed — уже разобранные (date.toordinal(), ParsedBooking); если не передано, разбираем row.
+    """
+    if parsed is None:
+        parsed = _parse_booking_row(row[0], row[3], row[4], row[2])
+    entry = PendingBooking(row, *(parsed or (None, None)))
+    _unflushed.append(entry)
+    _pending_rows.put_nowait(entry)
+    # набор броней изменился — проверки доступности нужно повторить.
+    # Чтения листа от этого не устаревают: очередь учитывается через _unflushed
+    _bk_cache["accepted"] += 1
+
+def _append_not_applied(exc: Exception) -> bool:
+    """
+    True, если запрос на запись точно не был выполнен: таблица отклонила его
+    (квота, ошибка 4xx), соединение не удалось установить (DNS, отказ в соединении)
+    или не удалось обновить токен доступа. После таймаута ответа или обрыва связи
+    строки могли уже записаться.
+    """
+    if isinstance(exc, gspread.exceptions.APIError):
+        status = getattr(getattr(exc, 'response', None), 'status_code', None)
+        return status is not None and 400 <= status < 500
+    if isinstance(exc, (ConnectTimeout, RefreshError, TransportError)):
+        return True
+    if isinstance(exc, RequestsConnectionError):
+        # requests оборачивает MaxRetryError, причина — в его reason
+        cause = exc.args[0] if exc.args else None
+        return isinstance(getattr(cause, 'reason', cause), NewConnectionError)
+    return False
+
+def _booking_row_key(row: Sequence[str]) -> Optional[Tuple]:
+    # ключ для поиска брони в листе: разобранные дата, время и ресурсы плюс имена
+    row = list(row) + [''] * (len(BOOKING_COLUMNS) - len(row))
+    parsed = _parse_booking_row(row[0], row[3], row[4], row[2])
+    if parsed is None:
+        return None
+    day, b = parsed
+    return day, b.start, b.end, tuple(sorted(b.resources)), str(row[1]).strip(), str(row[5]).strip()
+
+def _settle_uncertain(values: List[List[str]]):
+    """
+    По свежему (не пересекавшемуся с записью) чтению листа решает судьбу броней
+    из _uncertain: найденные в листе больше не считаются через _unflushed,
+    ненайденные снова ставятся в очередь на запись.
+    """
+    if not _uncertain:
+        return
+    in_sheet = Counter(_booking_row_key(row) for row in values[1:])
+    landed = set()
+    for e in _uncertain:
+        key = _booking_row_key(e.row)
+        if key is not None and in_sheet[key] > 0:
+            in_sheet[key] -= 1
+            landed.add(id(e))
+        else:
+            _pending_rows.put_nowait(e)
+    logging.info("Проверка по листу: записано броней — %d, повторно в очереди — %d",
+                 len(landed), len(_uncertain) - len(landed))
+    _unflushed[:] = [e for e in _unflushed if id(e) not in landed]
+    _uncertain.clear()
+
+async def _write_bookings(entries: List[PendingBooking]) -> bool:
+    """
+    Записывает брони в таблицу одним запросом values.append.
+    Если запрос точно не выполнен, брони возвращаются в очередь и будут записаны
+    при следующей попытке. Если исход неизвестен, сразу не повторяем, чтобы не задвоить
+    строки: брони ждут в _uncertain следующего чтения листа (_settle_uncertain).
+    """
+    sent = []  # непусто, если запрос values.append был отправлен
 
-async def append_booking_row(row: List[str]):
     def _append():
         sh = init_gsheets()
+        w = _get_ws(BOOKINGS_SHEET_NAME)
+        sent.append(True)
+        # INSERT_ROWS — дописываем в конец листа, не сдвигая существующие строки
+        sh.values_append(
+            f"'{w.title}'!A1",
+            params={'valueInputOption': 'USER_ENTERED', 'insertDataOption': 'INSERT_ROWS'},
+            # кортежи сериализуются в JSON так же, как списки
+            body={'values': [e.row for e in entries]},
+        )
+
+    async with _flush_lock:
+        # пока идёт запись, прочитанный лист не попадёт в кэш
+        _bk_cache["writing"] += 1
         try:
-            w = sh.worksheet(BOOKINGS_SHEET_NAME)
+            await _run_sheets(_append)
+        except Exception as exc:
+            if not sent or _append_not_applied(exc):
+                logging.exception("Не удалось записать %d брони(-ей) в таблицу, повторим позже", len(entries))
+                for e in entries:
+                    _pending_rows.put_nowait(e)
+                return False
+            logging.exception("Неизвестно, записаны ли %d брони(-ей) в таблицу, проверим по листу",
+                              len(entries))
+            # до проверки брони остаются в _unflushed и учитываются при проверке доступности
+            _uncertain.extend(entries)
+            _bk_cache["value"] = None
+            _bk_cache["gen"] += 1
+            prefetch_sheets()
+            return False
+        finally:
+            _bk_cache["writing"] -= 1
+
+        written = {id(e) for e in entries}
+        _unflushed[:] = [e for e in _unflushed if id(e) not in written]
+        _add_to_bookings_cache(entries)
+        return True
+
+async def flush_bookings():
+    # записать всё, что сейчас в очереди (используется при остановке бота)
+    async with _flush_lock:
+        pass  # дожидаемся начатой записи: при ошибке она вернёт брони в очередь
+    if _uncertain:
+        # брони с неизвестным исходом записи сверяем с листом, иначе они потеряются
+        try:
+            await get_bookings()
         except Exception:
-            w = sh.get_worksheet(1)
-        w.insert_row(row, index=2, value_input_option='USER_ENTERED')
-    await asyncio.to_thread(_append)
+            logging.exception("Не удалось проверить по листу брони: %r", [e.row for e in _uncertain])
+    entries: List[PendingBooking] = []
+    while not _pending_rows.empty():
+        entries.append(_pending_rows.get_nowait())
+    if entries:
+        await _write_bookings(entries)
+
+async def flush_bookings_loop():
+    """
+    Ждёт первую бронь, затем BOOKINGS_FLUSH_WINDOW секунд добирает следующие
+    (не больше BOOKINGS_FLUSH_BATCH) и записывает их одним запросом.
+    """
+    while True:
+        entries = [await _pending_rows.get()]
+        try:
+            deadline = monotonic() + BOOKINGS_FLUSH_WINDOW
+            while len(entries) < BOOKINGS_FLUSH_BATCH:
+                timeout = deadline - monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    entries.append(await asyncio.wait_for(_pending_rows.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+        except asyncio.CancelledError:
+            # бот останавливается — вернём собранное в очередь для flush_bookings()
+            for e in entries:
+                _pending_rows.put_nowait(e)
+            raise
+        # shield: остановка бота не должна обрывать уже начатую запись
+        if not await asyncio.shield(_write_bookings(entries)):
+            await asyncio.sleep(BOOKINGS_RETRY_DELAY)
+
+_flush_task: Optional[asyncio.Task] = None
+
+@dp.startup()
+async def on_startup():
+    global _flush_task
+    _flush_task = asyncio.create_task(flush_bookings_loop())
+
+@dp.shutdown()
+async def on_shutdown():
+    if _flush_task:
+        _flush_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await _flush_task
+    # не теряем брони, принятые перед остановкой
+    await flush_bookings()
+    # предзагрузка больше не нужна; без отмены чтение, повторяемое после 429,
+    # попыталось бы запустить запрос в уже остановленном пуле
+    pending = list(_background_tasks) + list(_inflight.values())
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    # дожидаемся запросов, уже выполняющихся в потоках, не блокируя event loop
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, functools.partial(_SHEETS_POOL.shutdown, wait=True))
+
+# Фоновые задачи храним, чтобы их не собрал сборщик мусора до завершения
+_background_tasks: set = set()
+
+def _background_done(task: asyncio.Task):
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logging.warning("Не удалось заранее прочитать таблицу: %r", task.exception())
+
+def prefetch_sheets():
+    """
+    Заранее читает инвентарь и бронирования в кэш, пока пользователь
+    заполняет следующие шаги, чтобы проверка доступности не ждала таблицу.
+    """
+    if _cache_fresh(_inv_cache) and _cache_fresh(_bk_cache):
+        return
+    task = asyncio.create_task(get_inventory_and_bookings())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_done)
 
 # ----------------- Вспомогательные функции -----------------
+# Разделители позиций и разбор одной позиции: "имя:кол-во", "имя кол-во" или просто "имя"
+_RES_SEP_RE = re.compile(r'[;,\n]')
+_RES_ITEM_RE = re.compile(r'([^:]*?)\s*(?::(.*)| (\d+))?')
+
 def parse_resources(text: str) -> Dict[str, int]:
     """
     Ожидает формат: "Oscilloscope:2; Laptop:1" или "Oscilloscope 2, Laptop 1"
     Возвращает словарь {equipment_name: count}
     """
     res = {}
-    for sep in [';', ',', '\n']:
-        text = text.replace(sep, ';')
-    for chunk in text.split(';'):
+    for chunk in _RES_SEP_RE.split(text):
         chunk = chunk.strip()
         if not chunk:
             continue
-        if ':' in chunk:
-            name, cnt = chunk.split(':', 1)
+        name, cnt, num = _RES_ITEM_RE.fullmatch(chunk).groups()
+        if num is not None:
+            cnt_i = int(num)
         else:
-            tokens = chunk.strip().rsplit(' ', 1)
-            if len(tokens) == 2 and tokens[1].isdigit():
-                name, cnt = tokens[0], tokens[1]
-            else:
-                name, cnt = chunk, '1'
-        try:
-            cnt_i = int(cnt.strip())
-        except:
-            cnt_i = 1
+            try:
+                cnt_i = int(cnt.strip()) if cnt is not None else 1
+            except ValueError:
+                cnt_i = 1
         res[name.strip()] = cnt_i
     return res
 
-def times_overlap(s1: time, e1: time, s2: time, e2: time) -> bool:
-    return (s1 < e2) and (s2 < e1)
+@functools.lru_cache(maxsize=4096)
+def _parse_resources_items(text: str) -> Tuple[Tuple[str, int], ...]:
+    # строки листа бронирований почти не меняются между обновлениями кэша,
+    # поэтому результат разбора запоминаем (в неизменяемом виде)
+    return tuple(parse_resources(text).items())
+
+# Даты и время внутри бота храним целыми числами:
+# дата — date.toordinal(), время — минуты от начала суток
+def parse_date(text: str) -> date:
+    # fromisoformat быстрее strptime; strptime оставлен для записей вида 2026-3-5
+    try:
+        return date.fromisoformat(text)
+    except ValueError:
+        return datetime.strptime(text, "%Y-%m-%d").date()
+
+def parse_time(text: str) -> time:
+    # аналогично: strptime нужен для времени без ведущего нуля (9:00)
+    try:
+        return time.fromisoformat(text)
+    except ValueError:
+        return datetime.strptime(text, "%H:%M").time()
+
+def to_minutes(t: time) -> int:
+    return t.hour * 60 + t.minute
+
+def format_minutes(m: int) -> str:
+    return f"{m // 60:02d}:{m % 60:02d}"
+
+class ParsedBooking(NamedTuple):
+    start: int  # минуты от начала суток
+    end: int
+    resources: Sequence[Tuple[str, int]]  # пары (имя, количество)
+
+class DayBookings(NamedTuple):
+    # брони одного дня, отсортированные по времени начала; starts[i] == bookings[i].start
+    starts: List[int]
+    bookings: List[ParsedBooking]
+
+def find_key(headers: List[str], substrs) -> Optional[int]:
+    # номер первой колонки, в заголовке которой есть одна из подстрок
+    for i, h in enumerate(headers):
+        hlow = h.lower()
+        for s in substrs:
+            if s in hlow:
+                return i
+    return None
+
+# В листе бронирований одни и те же даты и времена повторяются во многих строках,
+# поэтому каждое уникальное значение разбираем один раз
+@functools.lru_cache(maxsize=4096)
+def _day_of(text: str) -> int:
+    return parse_date(text).toordinal()
+
+@functools.lru_cache(maxsize=2048)
+def _minutes_of(text: str) -> int:
+    return to_minutes(parse_time(text))
+
+def _parse_booking_row(date_raw, start_raw, end_raw, resources_raw) -> Optional[Tuple[int, ParsedBooking]]:
+    """
+    Разбирает одну бронь: (date.toordinal(), ParsedBooking) или None для некорректной строки.
+    """
+    try:
+        row_date = _day_of(str(date_raw).strip())
+        row_start = _minutes_of(str(start_raw).strip())
+        row_end = _minutes_of(str(end_raw).strip())
+    except ValueError:
+        return None
+    row_resources = _parse_resources_items(str(resources_raw))
+    return row_date, ParsedBooking(row_start, row_end, row_resources)
+
+def _index_bookings(values: List[List[str]]) -> Dict[int, DayBookings]:
+    """
+    Строит индекс {date.toordinal(): DayBookings} по значениям листа бронирований
+    (первая строка — заголовки). Некорректные строки пропускаются.
+    """
+    by_date: Dict[int, List[ParsedBooking]] = {}
+    if not values:
+        return {}
+
+    # ищем номера колонок по заголовкам один раз
+    headers = values[0]
+    cols = [
+        find_key(headers, ['дата', 'date']),
+        find_key(headers, ['время начала', 'start', 'начало']),
+        find_key(headers, ['время окончания', 'end', 'конец']),
+        find_key(headers, ['ресурс', 'resource', 'необходим']),
+    ]
+    if None in cols:
+        return {}
+    date_col, start_col, end_col, resources_col = cols
+    width = max(cols) + 1
+
+    for row in values[1:]:
+        if len(row) < width:
+            # пустые ячейки в конце строки API не возвращает
+            row = row + [''] * (width - len(row))
+        parsed = _parse_booking_row(row[date_col], row[start_col], row[end_col], row[resources_col])
+        if parsed:
+            row_date, booking = parsed
+            by_date.setdefault(row_date, []).append(booking)
+
+    index: Dict[int, DayBookings] = {}
+    for row_date, day in by_date.items():
+        day.sort(key=lambda b: b.start)
+        index[row_date] = DayBookings([b.start for b in day], day)
+    return index
 
 async def check_availability(
-    booking_date: date,
-    start_time: time,
-    end_time: time,
-    requested: Dict[str, int]
+    booking_day: int,
+    start_min: int,
+    end_min: int,
+    requested: Sequence[Tuple[str, int]]
 ) -> Tuple[bool, str]:
-    inventory = await get_inventory()
-    bookings = await get_bookings()
-
-    def find_key(row_keys, substrs):
-        for k in row_keys:
-            klow = k.lower()
-            for s in substrs:
-                if s in klow:
-                    return k
-        return None
+    """
+    booking_day — date.toordinal(), start_min/end_min — минуты от начала суток,
+    requested — пары (имя, количество).
+    """
+    inventory, bookings = await get_inventory_and_bookings()
+    return check_availability_local(inventory, bookings, booking_day, start_min, end_min, requested)
+
+def check_availability_local(
+    inventory: Dict[str, int],
+    bookings: Dict[int, DayBookings],
+    booking_day: int,
+    start_min: int,
+    end_min: int,
+    requested: Sequence[Tuple[str, int]]
+) -> Tuple[bool, str]:
+    """
+    То же, что check_availability, но по уже прочитанным данным — без обращения к таблице.
+    """
+    inventory_ci = inventory_lookup(inventory)
 
+    # имена сравниваем без учёта регистра и пробелов по краям
     conflicts_counts: Dict[str, int] = {}
 
-    for row in bookings:
-        keys = list(row.keys())
-        date_key = find_key(keys, ['дата', 'date'])
-        start_key = find_key(keys, ['время начала', 'start', 'начало'])
-        end_key = find_key(keys, ['время окончания', 'end', 'конец'])
-        resources_key = find_key(keys, ['ресурс', 'resource', 'необходим'])
-        if not date_key or not start_key or not end_key or not resources_key:
-            continue
-        try:
-            row_date = datetime.strptime(str(row[date_key]).strip(), "%Y-%m-%d").date()
-        except:
-            continue
-        if row_date != booking_date:
-            continue
-        try:
-            row_start = datetime.strptime(str(row[start_key]).strip(), "%H:%M").time()
-            row_end = datetime.strptime(str(row[end_key]).strip(), "%H:%M").time()
-        except:
-            continue
-        if not times_overlap(start_time, end_time, row_start, row_end):
+    # смотрим только брони на ту же дату, начавшиеся раньше end_min
+    day = bookings.get(booking_day)
+    candidates = list(day.bookings[:bisect_left(day.starts, end_min)]) if day else []
+    # плюс брони, которые ещё не успели записаться в таблицу
+    candidates += [e.booking for e in _unflushed if e.day == booking_day and e.booking.start < end_min]
+    for b in candidates:
+        if b.end <= start_min:
             continue
-        row_resources = parse_resources(str(row[resources_key]))
-        for name, cnt in row_resources.items():
-            conflicts_counts[name] = conflicts_counts.get(name, 0) + cnt
-
-    for name, cnt in requested.items():
-        inv_cnt = 0
-        for inv_name, inv_num in inventory.items():
-            if inv_name.strip().lower() == name.strip().lower():
-                inv_cnt = inv_num
-                break
+        for name, cnt in b.resources:
+            key = name.strip().lower()
+            conflicts_counts[key] = conflicts_counts.get(key, 0) + cnt
+
+    for name, cnt in requested:
+        key = name.strip().lower()
+        inv_cnt = inventory_ci.get(key, 0)
         if inv_cnt == 0:
             return False, f"Оборудование '{name}' не найдено в инвентаре или его количество равно 0."
-        used = conflicts_counts.get(name, 0)
+        used = conflicts_counts.get(key, 0)
         free = inv_cnt - used
         if free < cnt:
-            return False, f"На {booking_date.isoformat()} с {start_time.strftime('%H:%M')} до {end_time.strftime('%H:%M')} свободно только {free} шт '{name}', а запрошено {cnt}."
+            return False, f"На {date.fromordinal(booking_day).isoformat()} с {format_minutes(start_min)} до {format_minutes(end_min)} свободно только {free} шт '{name}', а запрошено {cnt}."
     return True, "Доступно"
 
+class BookingDraft(NamedTuple):
+    """
+    Собранная бронь перед подтверждением. Первые шесть полей — строка для листа
+    BOOKINGS в порядке BOOKING_COLUMNS. В FSM хранится одним списком (draft).
+    """
+    booking_date: str
+    employee_name: str
+    resources: str
+    start_time: str
+    end_time: str
+    manager_name: str
+    booking_day: int  # date.toordinal()
+    start_min: int    # минуты от начала суток
+    end_min: int
+    requested_parsed: Sequence[Tuple[str, int]]  # пары (имя, количество)
+
+    @classmethod
+    def from_state(cls, data: Dict) -> "BookingDraft":
+        return cls(*(data.get(f) for f in cls._fields[:-1]), data.get('requested_parsed') or ())
+
+    def row(self) -> Tuple[str, ...]:
+        return self[:6]
+
+    def parsed(self) -> Tuple[int, ParsedBooking]:
+        # дата и время уже числами — строки повторно не разбираем
+        return self.booking_day, ParsedBooking(self.start_min, self.end_min, self.requested_parsed)
+
+# Отличает этот процесс от других процессов бота и от него же после перезапуска:
+# счётчик принятых броней имеет смысл только внутри одного процесса
+_INSTANCE_ID = uuid.uuid4().hex
+
+def availability_version() -> List:
+    # список, а не кортеж: так значение одинаково выглядит и в MemoryStorage, и после JSON в Redis
+    return [_INSTANCE_ID, _bk_cache["accepted"]]
+
+def availability_recent(data: Dict) -> bool:
+    """
+    True, если проверка из process_manager ещё актуальна: прошло меньше
+    AVAILABILITY_GRACE секунд, подтверждение обрабатывает тот же процесс
+    и с тех пор он не принимал новых броней.
+    """
+    return (data.get('checked_gen') == availability_version()
+            and unix_time() - data.get('checked_at', 0) < AVAILABILITY_GRACE)
+
 # ----------------- Утилиты для inline выбора (с пагинацией) -----------------
-async def build_inventory_keyboard(inventory: Dict[str, int], page: int = 0, page_size: int = PAGE_SIZE) -> Tuple[InlineKeyboardMarkup, Dict[str, str], int]:
+async def build_inventory_keyboard(inventory: Dict[str, int], page: int = 0, page_size: int = PAGE_SIZE) -> Tuple[InlineKeyboardMarkup, int]:
     """
-    Возвращает (keyboard, callback_map, total_pages).
-    callback_map: короткий ключ -> полное имя оборудования (ключи вида i{idx})
+    Возвращает (keyboard, total_pages).
+    В callback_data кнопок — индекс позиции в инвентаре (select:{idx}).
     keyboard содержит только slice для page.
     """
-    items = list(inventory.items())
+    items = inventory_items(inventory)
     total = len(items)
     total_pages = max(1, math.ceil(total / page_size))
     # нормализуем страницу
     page = max(0, min(page, total_pages - 1))
 
-    # создаём callback_map для всех элементов (ключи привязаны к индексам)
-    callback_map: Dict[str, str] = {}
-    for idx, (name, _) in enumerate(items):
-        callback_map[f"i{idx}"] = name
-
     # строим видимые кнопки для текущей страницы
     start = page * page_size
     end = start + page_size
     rows = []
     for idx in range(start, min(end, total)):
         name, cnt = items[idx]
-        key = f"i{idx}"
-        btn = InlineKeyboardButton(text=f"{name} ({cnt})", callback_data=f"select:{key}")
+        btn = InlineKeyboardButton(text=f"{name} ({cnt})", callback_data=f"select:{idx}")
         rows.append([btn])
 
     # строка корзина/завершить/ручной ввод
@@ -268,7 +887,24 @@ async def build_inventory_keyboard(inventory: Dict[str, int], page: int = 0, pag
         rows.append(nav_row)
 
     kb = InlineKeyboardMarkup(inline_keyboard=rows)
-    return kb, callback_map, total_pages
+    return kb, total_pages
+
+async def edit_or_answer(message: Message, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None):
+    """
+    Обновляет сообщение с кнопками вместо отправки нового.
+    Новое сообщение отправляется, только если старое отредактировать нельзя.
+    """
+    try:
+        await message.edit_text(text, reply_markup=reply_markup)
+    except TelegramBadRequest as e:
+        # текст совпадает — обновляем только клавиатуру
+        if "message is not modified" in str(e):
+            try:
+                await message.edit_reply_markup(reply_markup=reply_markup)
+            except TelegramBadRequest:
+                pass
+            return
+        await message.answer(text, reply_markup=reply_markup)
 
 # ----------------- Команды бота -----------------
 @dp.message(Command(commands=["start"]))
@@ -313,11 +949,12 @@ async def cmd_book(message: Message, state: FSMContext):
 async def process_date(message: Message, state: FSMContext):
     txt = message.text.strip()
     try:
-        dt = datetime.strptime(txt, "%Y-%m-%d").date()
+        dt = parse_date(txt)
     except:
         await message.answer("Неправильный формат даты. Введите YYYY-MM-DD.")
         return
-    await state.update_data(booking_date=dt.isoformat())
+    await state.update_data(booking_date=dt.isoformat(), booking_day=dt.toordinal())
+    prefetch_sheets()
     await message.answer("Введите время начала в формате HH:MM (например 09:00):")
     await state.set_state(BookingStates.waiting_for_start)
 
@@ -325,11 +962,11 @@ async def process_date(message: Message, state: FSMContext):
 async def process_start(message: Message, state: FSMContext):
     txt = message.text.strip()
     try:
-        t = datetime.strptime(txt, "%H:%M").time()
+        t = parse_time(txt)
     except:
         await message.answer("Неправильный формат времени. Введите HH:MM.")
         return
-    await state.update_data(start_time=t.strftime("%H:%M"))
+    await state.update_data(start_time=t.strftime("%H:%M"), start_min=to_minutes(t))
     await message.answer("Введите время окончания в формате HH:MM (например 12:30):")
     await state.set_state(BookingStates.waiting_for_end)
 
@@ -337,16 +974,16 @@ async def process_start(message: Message, state: FSMContext):
 async def process_end(message: Message, state: FSMContext):
     txt = message.text.strip()
     try:
-        t = datetime.strptime(txt, "%H:%M").time()
+        t = parse_time(txt)
     except:
         await message.answer("Неправильный формат времени. Введите HH:MM.")
         return
     data = await state.get_data()
-    start = datetime.strptime(data['start_time'], "%H:%M").time()
-    if t <= start:
+    end_min = to_minutes(t)
+    if end_min <= data['start_min']:
         await message.answer("Время окончания должно быть позже времени начала.")
         return
-    await state.update_data(end_time=t.strftime("%H:%M"))
+    await state.update_data(end_time=t.strftime("%H:%M"), end_min=end_min)
     await message.answer("Введите имя и фамилию сотрудника(-ков), кто будет работать:")
     await state.set_state(BookingStates.waiting_for_name)
 
@@ -360,9 +997,9 @@ async def process_name(message: Message, state: FSMContext):
 
     # Переходим к выбору ресурсов — отправляем inline-кнопки (страница 0)
     inv = await get_inventory()
-    kb, cmap, total_pages = await build_inventory_keyboard(inv, page=0)
-    # Инициализируем пустую корзину и callback_map и текущую страницу
-    await state.update_data(cart={}, callback_map=cmap, inv_page=0)
+    kb, total_pages = await build_inventory_keyboard(inv, page=0)
+    # Инициализируем пустую корзину и текущую страницу
+    await state.update_data(cart={}, inv_page=0)
     await message.answer("Выберите необходимые ресурсы через кнопки. Можно добавлять несколько позиций.", reply_markup=kb)
     await state.set_state(BookingStates.waiting_for_resources)
 
@@ -370,21 +1007,19 @@ async def process_name(message: Message, state: FSMContext):
 @dp.callback_query(lambda c: c.data and c.data.startswith('select:'))
 async def select_equipment(call: types.CallbackQuery, state: FSMContext):
     key = call.data.split(':', 1)[1]
-    data = await state.get_data()
-    callback_map = data.get('callback_map', {})
-    name = callback_map.get(key)
-    if not name:
+    inv = await get_inventory()
+    item = inventory_item(inv, key)
+    if not item:
         # Кнопка устарела — предложим обновить клавиатуру
-        inv = await get_inventory()
-        kb, cmap, _ = await build_inventory_keyboard(inv, page=0)
-        await state.update_data(callback_map=cmap, inv_page=0)
-        await call.message.answer("Эта кнопка устарела. Обновляю список — выберите снова:", reply_markup=kb)
+        kb, _ = await build_inventory_keyboard(inv, page=0)
+        await state.update_data(inv_page=0)
+        await edit_or_answer(call.message, "Эта кнопка устарела. Обновляю список — выберите снова:", reply_markup=kb)
         await call.answer()
         return
 
-    inv = await get_inventory()
-    max_cnt = inv.get(name, 0)
-    await state.update_data(temp_select={'key': key, 'name': name, 'count': 1})
+    name, max_cnt = item
+    # temp_select — компактная пара (ключ кнопки, количество)
+    await state.update_data(temp_select=(key, 1))
 
     kb_rows = [
         [
@@ -398,7 +1033,7 @@ async def select_equipment(call: types.CallbackQuery, state: FSMContext):
         ]
     ]
     kb = InlineKeyboardMarkup(inline_keyboard=kb_rows)
-    await call.message.answer(f"Выбрано: {name}\nДоступно: {max_cnt}\nКоличество: 1", reply_markup=kb)
+    await edit_or_answer(call.message, f"Выбрано: {name}\nДоступно: {max_cnt}\nКоличество: 1", reply_markup=kb)
     await call.answer()
 
 @dp.callback_query(lambda c: c.data and c.data.startswith('qty:'))
@@ -407,13 +1042,13 @@ async def qty_handler(call: types.CallbackQuery, state: FSMContext):
     if len(parts) < 2:
         await call.answer()
         return
+    # инвентарь читаем один раз на всё нажатие
+    inv = await get_inventory()
     if parts[1] == 'cancel':
-        await call.message.answer('Выбор отменён.')
+        kb, _ = await build_inventory_keyboard(inv, page=0)
+        await state.update_data(inv_page=0)
+        await edit_or_answer(call.message, 'Выбор отменён. Выберите ещё:', reply_markup=kb)
         await call.answer()
-        inv = await get_inventory()
-        kb, cmap, _ = await build_inventory_keyboard(inv, page=0)
-        await state.update_data(callback_map=cmap, inv_page=0)
-        await call.message.answer('Выберите ещё:', reply_markup=kb)
         return
     if len(parts) != 3:
         await call.answer()
@@ -421,24 +1056,20 @@ async def qty_handler(call: types.CallbackQuery, state: FSMContext):
     _, key, action = parts[0], parts[1], parts[2]
 
     data = await state.get_data()
-    callback_map = data.get('callback_map', {})
-    name = callback_map.get(key)
-    if not name:
-        inv = await get_inventory()
-        kb, cmap, _ = await build_inventory_keyboard(inv, page=0)
-        await state.update_data(callback_map=cmap, inv_page=0)
-        await call.message.answer("Кнопка устарела. Обновляю список — выберите снова:", reply_markup=kb)
+    item = inventory_item(inv, key)
+    if not item:
+        kb, _ = await build_inventory_keyboard(inv, page=0)
+        await state.update_data(inv_page=0)
+        await edit_or_answer(call.message, "Кнопка устарела. Обновляю список — выберите снова:", reply_markup=kb)
         await call.answer()
         return
+    name, max_cnt = item
 
-    temp = data.get('temp_select') or {}
-    if temp.get('key') != key:
+    temp = data.get('temp_select') or (None, 1)
+    if temp[0] != key:
         count = 1
     else:
-        count = temp.get('count', 1)
-
-    inv = await get_inventory()
-    max_cnt = inv.get(name, 0)
+        count = temp[1]
 
     if action == 'inc':
         if count < max_cnt:
@@ -450,17 +1081,14 @@ async def qty_handler(call: types.CallbackQuery, state: FSMContext):
         cart = data.get('cart', {})
         cart[name] = cart.get(name, 0) + count
         await state.update_data(cart=cart)
-        await call.message.answer(f"Добавлено: {count} x {name} в корзину.")
-        await call.answer()
-        inv = await get_inventory()
         # оставляем пользователя на той же странице
         page = data.get('inv_page', 0)
-        kb, cmap, _ = await build_inventory_keyboard(inv, page=page)
-        await state.update_data(callback_map=cmap)
-        await call.message.answer('Выберите ещё или завершите выбор:', reply_markup=kb)
+        kb, _ = await build_inventory_keyboard(inv, page=page)
+        await edit_or_answer(call.message, f"Добавлено: {count} x {name} в корзину.\nВыберите ещё или завершите выбор:", reply_markup=kb)
+        await call.answer()
         return
 
-    await state.update_data(temp_select={'key': key, 'name': name, 'count': count})
+    await state.update_data(temp_select=(key, count))
     kb_rows = [
         [
             InlineKeyboardButton(text='➖', callback_data=f'qty:{key}:dec'),
@@ -473,10 +1101,7 @@ async def qty_handler(call: types.CallbackQuery, state: FSMContext):
         ]
     ]
     kb = InlineKeyboardMarkup(inline_keyboard=kb_rows)
-    try:
-        await call.message.edit_text(f"Выбрано: {name}\nДоступно: {max_cnt}\nКоличество: {count}", reply_markup=kb)
-    except Exception:
-        await call.message.answer(f"Выбрано: {name}\nДоступно: {max_cnt}\nКоличество: {count}", reply_markup=kb)
+    await edit_or_answer(call.message, f"Выбрано: {name}\nДоступно: {max_cnt}\nКоличество: {count}", reply_markup=kb)
     await call.answer()
 
 @dp.callback_query(lambda c: c.data and c.data.startswith('page:'))
@@ -491,27 +1116,24 @@ async def page_handler(call: types.CallbackQuery, state: FSMContext):
         await call.answer()
         return
     inv = await get_inventory()
-    kb, cmap, total_pages = await build_inventory_keyboard(inv, page=page)
-    await state.update_data(callback_map=cmap, inv_page=page)
+    kb, total_pages = await build_inventory_keyboard(inv, page=page)
+    await state.update_data(inv_page=page)
     try:
         await call.message.edit_reply_markup(reply_markup=kb)
-    except Exception:
-        await call.message.answer("Обновляю список:", reply_markup=kb)
+    except TelegramBadRequest as e:
+        # «not modified» — нажата кнопка текущей страницы, менять нечего
+        if "message is not modified" not in str(e):
+            await call.message.answer("Обновляю список:", reply_markup=kb)
     await call.answer()
 
 # ----------------------------------------------
 # Обновлённый view_cart и cart_actions с удалением одной единицы
 # ----------------------------------------------
-@dp.callback_query(lambda c: c.data == 'view_cart')
-async def view_cart(call: types.CallbackQuery, state: FSMContext):
-    data = await state.get_data()
-    cart = data.get('cart', {})
-    if not cart:
-        await call.message.answer('Корзина пуста.')
-        await call.answer()
-        return
-
-    # Формируем текст корзины и создаём карту индексов для безопасных callback'ов
+def render_cart(cart: Dict[str, int]) -> Tuple[str, InlineKeyboardMarkup, Dict[str, str]]:
+    """
+    Возвращает (текст корзины, клавиатура, cart_map).
+    cart_map: c{idx} -> имя позиции, для безопасных callback'ов.
+    """
     text_lines = ['Ваша корзина:']
     cart_map: Dict[str, str] = {}  # c{idx} -> name
     rows = []
@@ -530,11 +1152,20 @@ async def view_cart(call: types.CallbackQuery, state: FSMContext):
         InlineKeyboardButton(text='Очистить корзину', callback_data='cart:clear'),
         InlineKeyboardButton(text='Закрыть', callback_data='cart:close')
     ])
+    return '\n'.join(text_lines), InlineKeyboardMarkup(inline_keyboard=rows), cart_map
 
-    kb = InlineKeyboardMarkup(inline_keyboard=rows)
+@dp.callback_query(lambda c: c.data == 'view_cart')
+async def view_cart(call: types.CallbackQuery, state: FSMContext):
+    data = await state.get_data()
+    cart = data.get('cart', {})
+    if not cart:
+        await call.answer('Корзина пуста.')
+        return
+
+    text, kb, cart_map = render_cart(cart)
     # Сохраняем карту в состоянии, чтобы callback'ы могли ссылаться на реальные имена
     await state.update_data(cart_map=cart_map)
-    await call.message.answer('\n'.join(text_lines), reply_markup=kb)
+    await edit_or_answer(call.message, text, reply_markup=kb)
     await call.answer()
 
 @dp.callback_query(lambda c: c.data and c.data.startswith('cart:'))
@@ -555,7 +1186,9 @@ async def cart_actions(call: types.CallbackQuery, state: FSMContext):
 
     if action == 'clear':
         await state.update_data(cart={})
-        await call.message.answer('Корзина очищена.')
+        inv = await get_inventory()
+        kb, _ = await build_inventory_keyboard(inv, page=data.get('inv_page', 0))
+        await edit_or_answer(call.message, 'Корзина очищена. Выберите ресурсы:', reply_markup=kb)
         await call.answer()
         return
 
@@ -563,11 +1196,9 @@ async def cart_actions(call: types.CallbackQuery, state: FSMContext):
         # отправляем обратно меню инвентаря — на той же странице, где был пользователь
         inv = await get_inventory()
         page = data.get('inv_page', 0)
-        kb, cmap, _ = await build_inventory_keyboard(inv, page=page)
-        # обновляем callback_map в состоянии
-        await state.update_data(callback_map=cmap)
-        # отвечаем пользователю клавиатурой выбора
-        await call.message.answer('Выберите ещё или завершите выбор:', reply_markup=kb)
+        kb, _ = await build_inventory_keyboard(inv, page=page)
+        # возвращаем в сообщение клавиатуру выбора
+        await edit_or_answer(call.message, 'Выберите ещё или завершите выбор:', reply_markup=kb)
         await call.answer()
         return
 
@@ -578,80 +1209,35 @@ async def cart_actions(call: types.CallbackQuery, state: FSMContext):
         key = parts[2]
         name = cart_map.get(key)
         if not name:
-            await call.message.answer("Кнопка устарела — откройте корзину ещё раз.")
-            await call.answer()
+            await call.answer("Кнопка устарела — откройте корзину ещё раз.", show_alert=True)
             return
 
         if action == 'dec':
             current = cart.get(name, 0)
             if current <= 1:
                 cart.pop(name, None)
-                await state.update_data(cart=cart)
-                await call.message.answer(f"Позиция '{name}' удалена из корзины.")
+                status = f"Позиция '{name}' удалена из корзины."
             else:
                 cart[name] = current - 1
-                await state.update_data(cart=cart)
-                await call.message.answer(f"Уменьшено: {name} на 1. Теперь: {cart[name]}")
-            await call.answer()
-            # пересобираем и показываем обновлённую корзину
-            data2 = await state.get_data()
-            cart2 = data2.get('cart', {})
-            if not cart2:
-                await call.message.answer('Корзина пуста.')
-                return
-            text_lines = ['Ваша корзина:']
-            new_rows = []
-            new_cart_map: Dict[str, str] = {}
-            for idx, (n, q) in enumerate(cart2.items()):
-                text_lines.append(f"{idx+1}. {n}: {q}")
-                k = f"c{idx}"
-                new_cart_map[k] = n
-                new_rows.append([
-                    InlineKeyboardButton(text=f"−1 ({idx+1})", callback_data=f"cart:dec:{k}"),
-                    InlineKeyboardButton(text="Удалить", callback_data=f"cart:remove:{k}")
-                ])
-            new_rows.append([
-                InlineKeyboardButton(text='Очистить корзину', callback_data='cart:clear'),
-                InlineKeyboardButton(text='Закрыть', callback_data='cart:close')
-            ])
-            new_kb = InlineKeyboardMarkup(inline_keyboard=new_rows)
-            await state.update_data(cart_map=new_cart_map)
-            await call.message.answer('\n'.join(text_lines), reply_markup=new_kb)
-            return
+                status = f"Уменьшено: {name} на 1. Теперь: {cart[name]}"
+        elif name in cart:
+            cart.pop(name, None)
+            status = f"Позиция '{name}' полностью удалена из корзины."
+        else:
+            status = "Позиция уже отсутствует в корзине."
 
-        if action == 'remove':
-            if name in cart:
-                cart.pop(name, None)
-                await state.update_data(cart=cart)
-                await call.message.answer(f"Позиция '{name}' полностью удалена из корзины.")
-            else:
-                await call.message.answer("Позиция уже отсутствует в корзине.")
-            await call.answer()
-            # обновляем отображение корзины
-            data2 = await state.get_data()
-            cart2 = data2.get('cart', {})
-            if not cart2:
-                await call.message.answer('Корзина пуста.')
-                return
-            text_lines = ['Ваша корзина:']
-            new_rows = []
-            new_cart_map: Dict[str, str] = {}
-            for idx, (n, q) in enumerate(cart2.items()):
-                text_lines.append(f"{idx+1}. {n}: {q}")
-                k = f"c{idx}"
-                new_cart_map[k] = n
-                new_rows.append([
-                    InlineKeyboardButton(text=f"−1 ({idx+1})", callback_data=f"cart:dec:{k}"),
-                    InlineKeyboardButton(text="Удалить", callback_data=f"cart:remove:{k}")
-                ])
-            new_rows.append([
-                InlineKeyboardButton(text='Очистить корзину', callback_data='cart:clear'),
-                InlineKeyboardButton(text='Закрыть', callback_data='cart:close')
-            ])
-            new_kb = InlineKeyboardMarkup(inline_keyboard=new_rows)
-            await state.update_data(cart_map=new_cart_map)
-            await call.message.answer('\n'.join(text_lines), reply_markup=new_kb)
-            return
+        # пересобираем корзину в том же сообщении; если она опустела —
+        # возвращаем клавиатуру выбора, иначе у пользователя не останется кнопок
+        if cart:
+            text, kb, cart_map = render_cart(cart)
+        else:
+            inv = await get_inventory()
+            kb, _ = await build_inventory_keyboard(inv, page=data.get('inv_page', 0))
+            text, cart_map = 'Корзина пуста. Выберите ресурсы:', {}
+        await state.update_data(cart=cart, cart_map=cart_map)
+        await edit_or_answer(call.message, text, reply_markup=kb)
+        await call.answer(status)
+        return
 
     # fallback
     await call.answer()
@@ -670,12 +1256,14 @@ async def finish_selection(call: types.CallbackQuery, state: FSMContext):
     data = await state.get_data()
     cart = data.get('cart', {})
     if not cart:
-        await call.message.answer('Корзина пуста — выберите хотя бы один ресурс или введите вручную.')
-        await call.answer()
+        await call.answer('Корзина пуста — выберите хотя бы один ресурс или введите вручную.', show_alert=True)
         return
     resources_text = '; '.join([f"{k}:{v}" for k, v in cart.items()])
-    requested_parsed = {k: v for k, v in cart.items()}
+    # запрос храним готовым к проверке: отсортированные пары (имя, количество)
+    requested_parsed = tuple(sorted(cart.items()))
     await state.update_data(resources=resources_text, requested_parsed=requested_parsed)
+    # пока вводят руководителя, подгружаем данные для проверки доступности
+    prefetch_sheets()
     await call.message.answer(f"Вы выбрали:\n{resources_text}\n\nВведите имя руководителя проекта:")
     await state.set_state(BookingStates.waiting_for_manager)
     await call.answer()
@@ -687,8 +1275,9 @@ async def process_resources(message: Message, state: FSMContext):
     if not txt:
         await message.answer("Нужно указать хотя бы один ресурс.")
         return
-    requested = parse_resources(txt)
+    requested = tuple(sorted(parse_resources(txt).items()))
     await state.update_data(resources=txt, requested_parsed=requested)
+    prefetch_sheets()
     await message.answer("Введите имя руководителя проекта:")
     await state.set_state(BookingStates.waiting_for_manager)
 
@@ -699,29 +1288,28 @@ async def process_manager(message: Message, state: FSMContext):
     if not txt:
         await message.answer("Укажите имя руководителя проекта.")
         return
-    await state.update_data(manager_name=txt)
     data = await state.get_data()
+    data['manager_name'] = txt
+    draft = BookingDraft.from_state(data)
 
     # проверка доступности перед показом подтверждения
-    booking_date = datetime.strptime(data['booking_date'], "%Y-%m-%d").date()
-    start_time = datetime.strptime(data['start_time'], "%H:%M").time()
-    end_time = datetime.strptime(data['end_time'], "%H:%M").time()
-    requested = data.get('requested_parsed', {})
-
-    ok, msg = await check_availability(booking_date, start_time, end_time, requested)
+    ok, msg = await check_availability(draft.booking_day, draft.start_min, draft.end_min, draft.requested_parsed)
     if not ok:
         await message.answer(f"К сожалению, бронирование невозможно: {msg}")
         await state.clear()
         return
+    # сохраняем черновик одним значением и время проверки,
+    # чтобы при быстром подтверждении не проверять ещё раз
+    await state.update_data(draft=list(draft), checked_at=unix_time(), checked_gen=availability_version())
 
     # Формируем сводку и inline-кнопки подтверждения
     summary = (
         f"Подтвердите бронирование:\n"
-        f"Дата: {booking_date.isoformat()}\n"
-        f"Время: {start_time.strftime('%H:%M')} - {end_time.strftime('%H:%M')}\n"
-        f"Сотрудник(-и): {data['employee_name']}\n"
-        f"Ресурсы: {data.get('resources', '')}\n"
-        f"Руководитель проекта: {data['manager_name']}\n\n"
+        f"Дата: {draft.booking_date}\n"
+        f"Время: {draft.start_time} - {draft.end_time}\n"
+        f"Сотрудник(-и): {draft.employee_name}\n"
+        f"Ресурсы: {draft.resources or ''}\n"
+        f"Руководитель проекта: {draft.manager_name}\n\n"
     )
     kb_rows = [
         [
@@ -736,75 +1324,96 @@ async def process_manager(message: Message, state: FSMContext):
 @dp.callback_query(lambda c: c.data and c.data.startswith('confirm:'))
 async def confirm_handler(call: types.CallbackQuery, state: FSMContext):
     action = call.data.split(":", 1)[1]
-    if action == "cancel":
-        await call.message.answer("Бронирование отменено.")
-        await state.clear()
+    if action not in ("yes", "cancel"):
+        # неизвестная кнопка: состояние не трогаем
         await call.answer()
         return
+    if action == "yes":
+        data = await state.get_data()
+        if 'draft' not in data:
+            # повторное нажатие: бронь уже записана или отменена
+            await call.answer("Это бронирование уже обработано.")
+            return
+    try:
+        if action == "cancel":
+            await call.message.answer("Бронирование отменено.")
+            return
 
-    # action == "yes"
-    data = await state.get_data()
-    booking_date = datetime.strptime(data['booking_date'], "%Y-%m-%d").date()
-    start_time = datetime.strptime(data['start_time'], "%H:%M").time()
-    end_time = datetime.strptime(data['end_time'], "%H:%M").time()
-    requested = data.get('requested_parsed', {})
+        # action == "yes"
+        draft = BookingDraft(*data['draft'])
+        if not availability_recent(data):
+            ok, msg = await check_availability(draft.booking_day, draft.start_min, draft.end_min, draft.requested_parsed)
+            if not ok:
+                await call.message.answer(f"К сожалению, бронирование невозможно: {msg}")
+                return
 
-    ok, msg = await check_availability(booking_date, start_time, end_time, requested)
-    if not ok:
-        await call.message.answer(f"К сожалению, бронирование невозможно: {msg}")
+        await append_booking_row(draft.row(), draft.parsed())
+        await call.message.answer("Бронирование принято и будет записано в таблицу.")
+    finally:
+        # диалог завершён при любом исходе — состояние сбрасываем один раз.
+        # Сброс дожидаемся до выхода из обработчика: иначе следующее нажатие
+        # в этом чате может увидеть ещё не удалённый черновик
         await state.clear()
         await call.answer()
-        return
-
-    row = [
-        data['booking_date'],
-        data['employee_name'],
-        data['resources'],
-        data['start_time'],
-        data['end_time'],
-        data['manager_name']
-    ]
-    await append_booking_row(row)
-    await call.message.answer("Бронирование успешно записано в таблицу.")
-    await state.clear()
-    await call.answer()
 
 @dp.message(StateFilter(BookingStates.confirm))
 async def process_confirm_text(message: Message, state: FSMContext):
-    txt = message.text.strip().lower()
-    if txt in ("отмена", "cancel", "нет", "no"):
-        await message.answer("Бронирование отменено.")
-        await state.clear()
+    txt = (message.text or "").strip().casefold()
+    if txt not in CANCEL_WORDS and txt not in CONFIRM_WORDS:
+        # посторонний ответ: состояние не читаем и ничего не разбираем.
+        # Любую подготовку данных добавлять только в ветку подтверждения ниже.
+        await message.answer("Нажмите кнопку 'Подтвердить' или 'Отмена' внизу, или напишите 'да'/'отмена'.")
         return
-    if txt in ("да", "ok", "yes"):
+    try:
+        if txt in CANCEL_WORDS:
+            await message.answer("Бронирование отменено.")
+            return
         data = await state.get_data()
-        booking_date = datetime.strptime(data['booking_date'], "%Y-%m-%d").date()
-        start_time = datetime.strptime(data['start_time'], "%H:%M").time()
-        end_time = datetime.strptime(data['end_time'], "%H:%M").time()
-        requested = data.get('requested_parsed', {})
-
-        ok, msg = await check_availability(booking_date, start_time, end_time, requested)
-        if not ok:
-            await message.answer(f"К сожалению, бронирование невозможно: {msg}")
-            await state.clear()
+        if 'draft' not in data:
+            # повторный ответ: бронь уже записана или отменена
+            await message.answer("Это бронирование уже обработано.")
             return
-        row = [
-            data['booking_date'],
-            data['employee_name'],
-            data['resources'],
-            data['start_time'],
-            data['end_time'],
-            data['manager_name']
-        ]
-        await append_booking_row(row)
-        await message.answer("Бронирование успешно записано в таблицу.")
+        draft = BookingDraft(*data['draft'])
+        if not availability_recent(data):
+            ok, msg = await check_availability(draft.booking_day, draft.start_min, draft.end_min, draft.requested_parsed)
+            if not ok:
+                await message.answer(f"К сожалению, бронирование невозможно: {msg}")
+                return
+        await append_booking_row(draft.row(), draft.parsed())
+        await message.answer("Бронирование принято и будет записано в таблицу.")
+    finally:
+        # диалог завершён (отмена или подтверждение) — состояние сбрасываем один раз
         await state.clear()
-        return
-    await message.answer("Нажмите кнопку 'Подтвердить' или 'Отмена' внизу, или напишите 'да'/'отмена'.")
 
 # ----------------- Запуск бота -----------------
 if __name__ == "__main__":
-    import logging
-    logging.basicConfig(level=logging.INFO)
-    print("Bot started")
-    dp.run_polling(bot)
+    import logging.handlers
+    import queue
+    # записи уходят в очередь, а в поток вывода их пишет отдельный поток —
+    # event loop не блокируется на записи логов
+    log_queue = queue.SimpleQueue()
+    log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+    logging.basicConfig(level=logging.INFO, handlers=[logging.handlers.QueueHandler(log_queue)])
+    log_listener.start()
+    try:
+        import uvloop
+    except ImportError:
+        logging.info("uvloop не установлен, используется стандартный event loop")
+    else:
+        # libuv быстрее стандартного цикла на сетевом вводе-выводе
+        uvloop.install()
+    logging.info("Bot started")
+    try:
+        # каждый апдейт — отдельная задача: медленный обработчик одного чата не задерживает остальные.
+        # Место под задачу занимается до её создания: когда все MAX_CONCURRENT_UPDATES заняты,
+        # поллинг не берёт новые апдейты, и в памяти не копятся тысячи ждущих задач.
+        # Сколько мест может занять один чат, ограничивает limit_per_chat
+        dp.run_polling(
+            bot,
+            handle_as_tasks=True,
+            tasks_concurrency_limit=MAX_CONCURRENT_UPDATES,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+    finally:
+        # дописываем оставшиеся в очереди записи
+        log_listener.stop()